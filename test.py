@@ -4,8 +4,14 @@ import time
 import csv
 import falconpy
 import json
+import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 pretty = lambda d: print(json.dumps(d, indent=4))
 
@@ -30,90 +36,42 @@ class SessionException(Exception):
     pass
 
 class Report:
-    def __init__(self):
-        self._report_data = {}
-
-    def __setitem__(self, key, value):
-        encoded_val = value.encode('unicode_escape')
-
-        if self._report_data.get(key) is None:
-            self._report_data[key] = [encoded_val]
-        else:
-            self._report_data[key].append(encoded_val)
-
-    def _csv_output_file(self):
-        name = f"report_{datetime.now()}.csv"
-        file_obj = open(name, 'w')
-
-        return csv.writer(file_obj)
-
-    def _validate_dict(self):
-        keys = list(self._report_data)
-        size = len(self._report_data) - 1
-
-        return all(
-            [
-                len(self._report_data[keys[i]]) == len(self._report_data[keys[i+1]])
-                for i in range(size)
-            ]
-        )
-
-    def _dict_info(self):
-        keys = self._report_data.keys()
-        first_key = list(keys)[0]
-
-        return keys, range(len(self._report_data[first_key]))
-
-    def debug(self):
-        return self._report_data
-
-    def export_csv(self):
-        assert(self._validate_dict()), "Inconsistent column length"
-        
-        csv_writer = self._csv_output_file()
-
-        keys, rg_rows = self._dict_info()
-        data = [[self._report_data[k][row] for k in keys] for row in rg_rows]
-
-        csv_writer.writerow(keys)
-        csv_writer.writerows(data)
-
-class CommandsMeta(type):
-    def _run_script(self, script):
-        return f"runscript -Raw=```{script}```"
-
-    def _mac(self, new_name):
-        new_name_command = (f"sudo scutil --set ComputerName '{new_name}' && "
-                            f"sudo scutil --set LocalHostName '{new_name}' && "
-                            f"sudo scutil --set HostName '{new_name}'")
+    def __init__(self, fieldnames, started):
+        self.name = f"report_{started.strftime('%Y-%m-%dT%H-%M-%S.%f')}.csv"
+        self._file = open(self.name, 'x', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=fieldnames, restval="")
+        self._writer.writeheader()
 
-        return self._run_script(new_name_command)
+    def __enter__(self):
+        return self
 
-    def _windows(self, new_name):
-        new_name_command = f"Rename-Computer -NewName {new_name} -Force"
+    def __exit__(self, *exc):
+        self.close()
 
-        return self._run_script(new_name_command)
+    def append_row(self, row):
+        self._writer.writerow(row)
+        self._file.flush()
 
-    def _linux(self, new_name):
-        new_name_command = f"hostname {new_name}; hostname"
+    def close(self):
+        self._file.close()
 
-        return self._run_script(new_name_command)
+_PLATFORM_TEMPLATES = {
+    'mac': ("runscript -Raw=```"
+            "sudo scutil --set ComputerName '{n}' && "
+            "sudo scutil --set LocalHostName '{n}' && "
+            "sudo scutil --set HostName '{n}'"
+            "```"),
+    'windows': "runscript -Raw=```Rename-Computer -NewName {n} -Force```",
+    'linux': "runscript -Raw=```hostname {n}; hostname```",
+}
 
-    def __getitem__(self, name):
-        lower_name = name.lower()
-        match lower_name:
-            case 'mac':
-                return self._mac
-            case 'windows':
-                return self._windows
-            case 'linux':
-                return self._linux
-            case _:
-                raise Exception(f"Unknown platorm '{name}'")
+def command_for(platform, new_name):
+    try:
+        template = _PLATFORM_TEMPLATES[platform.lower()]
+    except KeyError:
+        raise Exception(f"Unknown platorm '{platform}'")
 
-class Commands(metaclass=CommandsMeta):
-    def __getattr__(self, name):
-        return getattr(type(self), name)
+    return template.format(n=new_name)
 
 
 class TokenInitializationException(Exception):
@@ -133,43 +91,86 @@ class RealTimeResponseAdminTokenException(TokenInitializationException):
 class FalconAccess:
     ID_KEY="FALCON_CLIENT_ID"
     SECRET_KEY="FALCON_CLIENT_SECRET"
+    TOKEN_RENEW_WINDOW = 60
 
     def __init__(self):
+        self._auth = None
         self._hosts = None
         self._rtr = None
         self._rtra = None
+        self._lock = threading.Lock()
+
+    def _pooled_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32,
+                              pool_maxsize=64,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        session.mount("https://", adapter)
+
+        return session
+
+    def ensure_authenticated(self):
+        with self._lock:
+            if self._auth is not None:
+                return self._auth
+
+            # Service classes built from this auth object share its session
+            auth = falconpy.OAuth2(client_id=os.getenv(self.ID_KEY),
+                                   client_secret=os.getenv(self.SECRET_KEY),
+                                   session=self._pooled_session())
+            auth.login()
+
+            if auth.token_status != 201:
+                raise TokenInitializationException("Unable to initialize token")
+
+            self._auth = auth
+            return self._auth
+
+    def refresh_if_expiring(self, threshold_s=TOKEN_RENEW_WINDOW):
+        auth = self.ensure_authenticated()
+
+        with self._lock:
+            elapsed = time.time() - (auth.token_time or 0)
+            if auth.token_expiration - elapsed < threshold_s:
+                auth.login()
+
+                if auth.token_status != 201:
+                    raise TokenInitializationException("Unable to renew token")
+
+        return auth
+
+    def _client(self, attr, service_class):
+        auth = self.refresh_if_expiring()
+
+        with self._lock:
+            if getattr(self, attr) is None:
+                setattr(self, attr, service_class(auth_object=auth))
+
+            return getattr(self, attr)
 
     @property
     def hosts(self):
-        if self._hosts is None:
-            self._hosts = falconpy.Hosts(client_id=os.getenv(self.ID_KEY),
-                                         client_secret=os.getenv(self.SECRET_KEY))
-
-        return self._hosts
+        return self._client('_hosts', falconpy.Hosts)
 
     @property
     def real_time_response(self):
-        if self._rtr is None:
-            self._rtr = falconpy.RealTimeResponse(client_id=os.getenv(self.ID_KEY),
-                                                  client_secret=os.getenv(self.SECRET_KEY))
-
-        return self._rtr
+        return self._client('_rtr', falconpy.RealTimeResponse)
 
     @property
     def real_time_response_admin(self):
-        if self._rtra is None:
-            self._rtra = falconpy.RealTimeResponseAdmin(client_id=os.getenv(self.ID_KEY),
-                                                       client_secret=os.getenv(self.SECRET_KEY))
+        return self._client('_rtra', falconpy.RealTimeResponseAdmin)
 
-        return self._rtra
+falcon_access = FalconAccess()
 
 class FalconData:
+    QUERY_LIMIT = 5000
+    SERIALS_CHUNK = 100
+    DETAILS_CHUNK = 100
+    BULK_WORKERS = 16
+
     def __init__(self, falcon_access):
         self._hosts = falcon_access.hosts
 
-        if self._hosts.token_status != 201:
-            raise HostTokenException("Unable to initialize token")
-
         print("Initiated falcon data")
 
     def _filter_by_serial_number(self, serial_number):
@@ -198,29 +199,65 @@ class FalconData:
         
         return self._resources(details_res)
 
+    def _chunks(self, items, size):
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def _bulk(self, fetch, items, chunk):
+        if not (chunks := self._chunks(items, chunk)):
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(chunks), self.BULK_WORKERS)) as ex:
+            return [res for results in ex.map(fetch, chunks) for res in results]
+
+    def _all_devices(self, serial_numbers):
+        serials_filter = ",".join(self._filter_by_serial_number(sn) for sn in serial_numbers)
+        device_ids = []
+        while True:
+            device_res = self._hosts.query_devices_by_filter(filter=serials_filter,
+                                                             limit=self.QUERY_LIMIT,
+                                                             offset=len(device_ids))
+
+            if device_res['status_code'] != 200:
+                raise QueryExecutionException(f"Query execution error for serial numbers: {serial_numbers}")
+
+            resources = self._resources(device_res)
+            device_ids.extend(resources)
+
+            total = device_res['body']['meta']['pagination']['total']
+            if not resources or len(device_ids) >= total:
+                return device_ids
+
+    def devices_bulk(self, serial_numbers, chunk=SERIALS_CHUNK):
+        return self._bulk(self._all_devices, serial_numbers, chunk)
+
+    def details_bulk(self, device_ids, chunk=DETAILS_CHUNK):
+        return self._bulk(self.details, device_ids, chunk)
+
 class FalconDevice:
     def __init__(self, falcon_access):
         self._rtr = falcon_access.real_time_response
 
-        if self._rtr.token_status != 201:
-            raise HostTokenException("Unable to initialize token")
-
         print("Initiated falcon device")
 
     def _resources(self, data):
         return data['body']['resources'][0]
 
     def init_sessions(self, device_ids, timeout=180):
+        batch = self._rtr.batch_init_sessions(host_ids=device_ids,
+                                              queue_offline=False,
+                                              timeout=timeout)
+
+        if (status := batch['status_code']) != 201:
+            raise SessionException(f"Unable to start sessions for devices {device_ids}, received status: {status}")
+
         sessions = []
+        resources = batch['body']['resources']
         for device_id in device_ids:
-            sess = self._rtr.init_session(device_id=device_id,
-                                          queue_offline=False,
-                                          timeout=timeout)
-
-            if (status := sess['status_code']) != 201:
-                raise SessionException(f"Unable to start session for device {device_id}, received status: {status}")
+            sess = resources.get(device_id)
+            if sess is None or sess.get('errors') or not sess.get('session_id'):
+                raise SessionException(f"Unable to start session for device {device_id}")
             else:
-                sessions.append(self._resources(sess))
+                sessions.append(sess)
 
         return sessions
 
@@ -235,20 +272,15 @@ class FalconAdmin:
     def __init__(self, falcon_access):
         self._rtra = falcon_access.real_time_response_admin
 
-        if self._rtra.token_status != 201:
-            raise HostTokenException("Unable to initialize token")
-
         print("Initiated falcon admin")
 
     def _resources(self, data):
         return data['body']['resources'][0]
 
-    def _check_command_not_completed(self, cloud_request_id):
-        cmd_check = self._rtra.RTR_CheckAdminCommandStatus(
-            cloud_request_id=cloud_request_id
-        )
+    def _completed_status(self, cloud_request_id):
+        status = self.get_command_status(cloud_request_id)
 
-        return self._resources(cmd_check)['complete'] == False
+        return status if status['complete'] else None
 
     def _build_file_payload(self, name, type_):
         with open(name, 'rb') as file:
@@ -256,7 +288,21 @@ class FalconAdmin:
 
             return [('file', (name, data, type_))]
 
-    def run_command(self, session_id, command, await_complete=True, tries=5):
+    def _await_completion(self, cloud_request_id, poll_backoff_min,
+                          poll_backoff_max, max_total_wait):
+        delay = poll_backoff_min
+        deadline = time.monotonic() + max_total_wait
+        while (status := self._completed_status(cloud_request_id)) is None:
+            if time.monotonic() >= deadline:
+                return None
+
+            time.sleep(delay)
+            delay = min(delay * 1.7, poll_backoff_max)
+
+        return status
+
+    def run_command(self, session_id, command, await_complete=True,
+                    poll_backoff_min=0.05, poll_backoff_max=5.0, max_total_wait=60):
         cmd = self._rtra.RTR_ExecuteAdminCommand(command_string=command,
                                                  persist_all=True,
                                                  session_id=session_id)
@@ -268,13 +314,16 @@ class FalconAdmin:
 
         if await_complete:
             cloud_request_id = resources['cloud_request_id']
-            curr_try = 0
-            while (self._check_command_not_completed(cloud_request_id) and
-                   curr_try < tries):
-                time.sleep(1)
-                curr_try += 1
+            status = self._await_completion(cloud_request_id, poll_backoff_min,
+                                            poll_backoff_max, max_total_wait)
+            if status is None:
+                print(f"Command {command} on session {session_id} did not complete "
+                      f"within {max_total_wait}s")
+                return None
+
+            resources = dict(resources, status=status)
 
-        return resources if curr_try < tries else None
+        return resources
     
     def get_command_status(self, cloud_request_id):
         cmd_status = self._rtra.RTR_CheckAdminCommandStatus(
@@ -306,7 +355,7 @@ class FalconAdmin:
         if await_complete:
             cloud_request_id = resources['cloud_request_id']
             curr_try = 0
-            while (self._check_command_not_completed(cloud_request_id) and
+            while (self._completed_status(cloud_request_id) is None and
                    curr_try < tries):
                 time.sleep(1)
                 curr_try += 1
@@ -315,68 +364,123 @@ class FalconAdmin:
             raise FileDeploymentTimeoutException("Deploy command timed out for file \"{name}\" on session {session_id}")
 
 def read_csv(file_name):
-    in_file = open(file_name)
-    return csv.DictReader(in_file)
+    with open(file_name, newline='') as in_file:
+        # Fields beyond the header land under the None restkey and are dropped
+        return [{k.strip(): (v or "").strip() for k, v in row.items() if k is not None}
+                for row in csv.DictReader(in_file)]
+
+REPORT_FIELDS = ('new_name', 'owner', 'serial_number', 'name', 'platform',
+                 'last_seen', 'stdout', 'stderr', 'status')
+
+MAX_WORKERS_KEY = "FALCON_MAX_WORKERS"
+
+detail_fields = itemgetter('platform_name', 'hostname', 'last_seen')
+sessid = itemgetter('session_id')
+
+def serial_key(serial_number):
+    """ Normalises a serial number for matching csv rows against device details """
+    return serial_number.strip().upper()
+
+def details_by_serial(falcon_data, serial_numbers):
+    """ Fetches the details for every serial number at once, grouped by serial number """
+    devices = falcon_data.devices_bulk(serial_numbers)
+    print(f"fetched devices: {devices}")
+    details = falcon_data.details_bulk(devices)
+    print(f"fetched details: {details}")
+
+    grouped = {}
+    for detail in details:
+        grouped.setdefault(serial_key(detail.get('serial_number') or ""), []).append(detail)
+
+    return grouped
+
+def process_row(data, details_map, falcon_device, falcon_admin):
+    """ Runs the whole pipeline for a single csv row, returning its report rows """
+    rows = []
+    base = {
+        'new_name': data['new_name'],
+        'owner': data['owner'],
+        'serial_number': data['serial_number'],
+    }
+
+    try:
+        if not data['serial_number']:
+            raise MissingDataException("No serial number provided")
+
+        falcon_access.refresh_if_expiring()
+
+        if (details := details_map.get(serial_key(data['serial_number']))) is None:
+            raise MissingDataException(f"No data found for serial number: {data['serial_number']}")
+        if isinstance(details, Exception):
+            raise details
+
+        for detail in details:
+            platform, hostname, last_seen = detail_fields(detail)
+            row = dict(base, name=hostname, platform=platform, last_seen=last_seen)
+
+            try:
+                sessions = falcon_device.init_sessions([detail['device_id']])
+                print("opened sessions")
+
+#                for session in sessions:
+#                    command = command_for(platform, data['new_name'])
+#                    resources = falcon_admin.run_command(sessid(session), command)
+#
+#                    row['stdout'] = resources['status']['stdout']
+#                    row['stderr'] = resources['status']['stderr']
+
+                name = "file_test_falcon_stuff.txt"
+                falcon_admin.upload_file(
+                        name,
+                        "This is a file that tests the falcon script for uploading files",
+                        "text/plain")
+
+                for session in sessions:
+                    falcon_admin.deploy_file(name, sessid(session))
+
+            except Exception as e:
+                row['stdout'] = ""
+                row['stderr'] = ""
+                row['status'] = str(e)
+            else:
+                row['status'] = "Success!"
 
-def main():
-    report = Report()
+            rows.append(row)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        rows.append(dict(base, status=str(e)))
 
-    platform = lambda d: d['platform_name']
-    hostname = lambda d: d['hostname']
-    last_seen = lambda d: d['last_seen']
-    sessid = lambda s: s['session_id']
+    return rows
 
-    access = FalconAccess()
+def main():
+    started = datetime.now()
 
-    falcon_data = FalconData(access)
-    falcon_device = FalconDevice(access)
-    falcon_admin = FalconAdmin(access)
+    falcon_access.ensure_authenticated()
 
-    csv_data = read_csv('devices-to-rename.csv')
+    falcon_data = FalconData(falcon_access)
+    falcon_device = FalconDevice(falcon_access)
+    falcon_admin = FalconAdmin(falcon_access)
 
+    csv_data = read_csv('devices-to-rename.csv')
+    serial_numbers = {}
     for data in csv_data:
-        try:
-            devices = falcon_data.devices(data['serial_number'])
-            print(f"fetched devices: {devices}")
-            details = falcon_data.details(devices)
-            print(f"fetched details: {details}")
-            for detail in details:
-                report['new_name'] = data['new_name']
-                report['owner'] = data['owner']
-                report['serial_number'] = data['serial_number']
-                report['name'] = hostname(detail)
-                report['platform'] = platform(detail)
-                report['last_seen'] = last_seen(detail)
-
-                try:
-                    sessions = falcon_device.init_sessions([detail['device_id']])
-                    print("opened sessions")
-
-#                    for session in sessions:
-#                        command = Commands[platform(detail)](data['new_name'])
-#                        resources = falcon_admin.run_command(sessid(session), command)
-#                        command_status = falcon_admin.get_command_status(resources['cloud_request_id'])
-#
-#                        report['stdout'] = command_status['stdout']
-#                        report['stderr'] = command_status['stderr']
-
-                    name = "file_test_falcon_stuff.txt"
-                    for session in sessions:
-                        falcon_admin.upload_file(
-                                name,
-                                "This is a file that tests the falcon script for uploading files",
-                                "text/plain")
-
-                        falcon_admin.deploy_file(name, sessid(session))
-
-                except Exception as e:
-                    report['stdout'] = ""
-                    report['stderr'] = ""
-                    report['status'] = str(e)
-                else:
-                    report['status'] = "Success!"
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            report['status'] = str(e)
-
-    report.export_csv()
+        if data['serial_number']:
+            serial_numbers.setdefault(serial_key(data['serial_number']), data['serial_number'])
+
+    try:
+        details_map = details_by_serial(falcon_data, list(serial_numbers.values()))
+    except Exception as e:
+        # Report the failed lookup against every row instead of aborting the run
+        print(f"An error occurred: {e}")
+        details_map = dict.fromkeys(serial_numbers, e)
+
+    max_workers = int(os.getenv(MAX_WORKERS_KEY, 16))
+
+    with (Report(REPORT_FIELDS, started) as report,
+          ThreadPoolExecutor(max_workers=max_workers) as ex):
+        futures = [ex.submit(process_row, data, details_map, falcon_device, falcon_admin)
+                   for data in csv_data]
+
+        for future in as_completed(futures):
+            for row in future.result():
+                report.append_row(row)
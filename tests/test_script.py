@@ -0,0 +1,150 @@
+import importlib.util
+import pathlib
+import types
+
+import pytest
+
+pytest.importorskip("falconpy")
+
+_spec = importlib.util.spec_from_file_location(
+    "crowdstrike_test", pathlib.Path(__file__).resolve().parent.parent / "test.py"
+)
+crowdstrike_test = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(crowdstrike_test)
+
+
+def _write(tmp_path, content):
+    path = tmp_path / "devices.csv"
+    path.write_text(content)
+    return path
+
+
+def test_read_csv_drops_fields_beyond_header(tmp_path):
+    path = _write(tmp_path,
+                  "serial_number,new_name,owner\n"
+                  "ABC123,new-host,Doe, John\n")
+
+    assert crowdstrike_test.read_csv(path) == [
+        {'serial_number': 'ABC123', 'new_name': 'new-host', 'owner': 'Doe'},
+    ]
+
+
+def test_read_csv_strips_whitespace_and_fills_short_rows(tmp_path):
+    path = _write(tmp_path,
+                  " serial_number , new_name ,owner\n"
+                  " ABC123 , new-host \n")
+
+    assert crowdstrike_test.read_csv(path) == [
+        {'serial_number': 'ABC123', 'new_name': 'new-host', 'owner': ''},
+    ]
+
+
+def test_read_csv_keeps_rows_without_serial_number(tmp_path):
+    path = _write(tmp_path,
+                  "serial_number,new_name,owner\n"
+                  ",new-host,jdoe\n")
+
+    rows = crowdstrike_test.read_csv(path)
+    assert rows == [{'serial_number': '', 'new_name': 'new-host', 'owner': 'jdoe'}]
+
+    report_rows = crowdstrike_test.process_row(rows[0], {}, None, None)
+    assert report_rows == [
+        {'new_name': 'new-host', 'owner': 'jdoe', 'serial_number': '',
+         'status': "No serial number provided"},
+    ]
+
+
+def test_process_row_reports_failed_bulk_lookup(monkeypatch):
+    error = crowdstrike_test.QueryExecutionException("Query execution error")
+    data = {'serial_number': 'ABC123', 'new_name': 'new-host', 'owner': 'jdoe'}
+    monkeypatch.setattr(crowdstrike_test.falcon_access, 'refresh_if_expiring', lambda: None)
+
+    report_rows = crowdstrike_test.process_row(data, {'ABC123': error}, None, None)
+
+    assert report_rows == [dict(data, status="Query execution error")]
+
+
+class FakeHosts:
+    def __init__(self, device_ids, details, page_size):
+        self._device_ids = device_ids
+        self._details = details
+        self._page_size = page_size
+        self.queries = []
+
+    def query_devices_by_filter(self, filter, limit, offset):
+        self.queries.append((filter, offset))
+        page = self._device_ids[offset:offset + self._page_size]
+        return {'status_code': 200,
+                'body': {'resources': page,
+                         'meta': {'pagination': {'total': len(self._device_ids)}}}}
+
+    def get_device_details(self, ids):
+        return {'status_code': 200,
+                'body': {'resources': [self._details[i] for i in ids]}}
+
+
+def test_devices_bulk_chunks_serials_and_follows_pagination():
+    hosts = FakeHosts(['a', 'b', 'c'], {}, page_size=2)
+    falcon_data = crowdstrike_test.FalconData(types.SimpleNamespace(hosts=hosts))
+
+    assert falcon_data.devices_bulk(['S1'], chunk=1) == ['a', 'b', 'c']
+    assert [offset for _, offset in hosts.queries] == [0, 2]
+
+    hosts.queries.clear()
+    falcon_data.devices_bulk(['S1', 'S2', 'S3'], chunk=2)
+    assert sorted(f for f, offset in hosts.queries if offset == 0) == [
+        "serial_number:'S1',serial_number:'S2'",
+        "serial_number:'S3'",
+    ]
+
+
+def test_details_by_serial_groups_by_normalised_serial():
+    details = {'a': {'device_id': 'a', 'serial_number': 'abc123'},
+               'b': {'device_id': 'b', 'serial_number': ' ABC123 '}}
+    hosts = FakeHosts(['a', 'b'], details, page_size=5000)
+    falcon_data = crowdstrike_test.FalconData(types.SimpleNamespace(hosts=hosts))
+
+    grouped = crowdstrike_test.details_by_serial(falcon_data, ['Abc123'])
+
+    assert grouped == {'ABC123': [details['a'], details['b']]}
+
+
+def test_falcon_clients_share_pooled_session(monkeypatch):
+    def login(auth):
+        auth.token_status = 201
+        auth.token_expiration = 1799
+        auth.token_time = crowdstrike_test.time.time()
+
+    monkeypatch.setattr(crowdstrike_test.falconpy.OAuth2, 'login', login)
+    access = crowdstrike_test.FalconAccess()
+    access.ensure_authenticated()
+
+    session = access.hosts.session
+    assert session is access.real_time_response_admin.session
+    assert session.get_adapter("https://api.crowdstrike.com")._pool_maxsize == 64
+
+
+def test_refresh_if_expiring_raises_on_failed_renewal(monkeypatch):
+    def login(auth):
+        auth.token_status = 401
+
+    access = crowdstrike_test.FalconAccess()
+    access._auth = crowdstrike_test.falconpy.OAuth2(client_id="id", client_secret="secret")
+    monkeypatch.setattr(crowdstrike_test.falconpy.OAuth2, 'login', login)
+
+    with pytest.raises(crowdstrike_test.TokenInitializationException):
+        access.refresh_if_expiring()
+
+
+def test_report_is_named_after_run_start(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    started = crowdstrike_test.datetime(2026, 10, 15, 12, 30, 0, 123456)
+
+    with crowdstrike_test.Report(('serial_number', 'status'), started) as report:
+        report.append_row({'serial_number': 'ABC123'})
+
+    assert report.name == "report_2026-10-15T12-30-00.123456.csv"
+    assert (tmp_path / report.name).read_bytes() == b"serial_number,status\r\nABC123,\r\n"
+
+    with pytest.raises(FileExistsError):
+        crowdstrike_test.Report(('serial_number',), started)